@@ -1,12 +1,15 @@
 import os
 import logging
-import google.auth
+from functools import lru_cache
 
 logger = logging.getLogger(__name__)
 
+@lru_cache(maxsize=1)
 def get_project_id():
     """
     Get the project ID from the environment or Google Cloud default credentials.
+    The result is cached for the life of the process; changes to PROJECT_ID or
+    credentials require a restart.
     """
     # 1. Try Environment Variable
     env_project_id = os.getenv("PROJECT_ID")
@@ -15,6 +18,9 @@ def get_project_id():
 
     # 2. Try Google Auth (Standard way for Cloud Run/GCE/Local ADC)
     try:
+        # Imported lazily: google.auth is heavy and unneeded when PROJECT_ID is set
+        import google.auth
+
         _, auth_project_id = google.auth.default()
         if auth_project_id:
             logger.info(f"Fetched PROJECT_ID from Google Auth: {auth_project_id}")
@@ -6,7 +6,9 @@ import base64
 import json
 import logging
 import inspect
-from typing import Optional, List, Dict, Callable
+from typing import Optional, List, Dict, Callable, Union
+
+from .spsc_queue import SPSCQueue
 
 logger = logging.getLogger(__name__)
 
@@ -40,8 +42,8 @@ class GeminiLive:
 
     async def start_session(
         self, 
-        audio_input_queue: asyncio.Queue,
-        video_input_queue: asyncio.Queue,
+        audio_input_queue: Union[asyncio.Queue, SPSCQueue],
+        video_input_queue: Union[asyncio.Queue, SPSCQueue],
         text_input_queue: asyncio.Queue,
         audio_output_callback: Callable,
         audio_interrupt_callback: Optional[Callable] = None,
@@ -1,19 +1,28 @@
-import base64
 import asyncio
-import json
+import hashlib
+import hmac
 import os
 import logging
+import secrets
 import time
-import uuid
-from typing import Dict, Optional
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import List, Optional
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, HTTPException
-from fastapi.responses import FileResponse
+import anyio.to_thread
+import orjson
+import pybase64
+
+from fastapi import FastAPI, WebSocket, Request, HTTPException
+from fastapi.responses import FileResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.websockets import WebSocketState
 
 from dotenv import load_dotenv
 from .gemini_live import GeminiLive
+from .spsc_queue import SPSCQueue
 from .config_utils import get_project_id
 
 # Load environment variables
@@ -28,9 +37,35 @@ PROJECT_ID = get_project_id()
 LOCATION = os.getenv("LOCATION", "us-central1")
 MODEL = os.getenv("MODEL", "gemini-live-2.5-flash-native-audio")
 SESSION_TIME_LIMIT = int(os.getenv("SESSION_TIME_LIMIT", "180"))
+# Set SERVE_STATIC=0 when dist/ is served by a CDN or reverse proxy instead
+SERVE_STATIC = os.getenv("SERVE_STATIC", "1") == "1"
+THREAD_POOL_SIZE = int(os.getenv("THREAD_POOL_SIZE", "200"))
+
+# Per-session input queue sizes (~2s of 16 kHz audio at typical chunk sizes)
+AUDIO_QUEUE_SIZE = 64
+VIDEO_QUEUE_SIZE = 8
+TEXT_QUEUE_SIZE = 32
+# Window for coalescing outbound audio chunks into one frame (seconds)
+AUDIO_FLUSH_INTERVAL = 0.005
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # FileResponse and other sync work run in anyio's thread pool, which
+    # defaults to 40 threads and stalls requests under bursts
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREAD_POOL_SIZE
+
+    # One GeminiLive (and its genai client) shared by all sessions; each
+    # session opens its own live connection via start_session().
+    app.state.gemini_client = GeminiLive(
+        project_id=PROJECT_ID,
+        location=LOCATION,
+        model=MODEL,
+        input_sample_rate=16000
+    )
+    yield
 
 # Initialize FastAPI
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -44,42 +79,113 @@ app.add_middleware(
 # app.mount("/static", StaticFiles(directory="frontend"), name="static")
 
 # Mount assets and other static directories from dist
-if os.path.exists("dist/assets"):
+if SERVE_STATIC and os.path.exists("dist/assets"):
     app.mount("/assets", StaticFiles(directory="dist/assets"), name="assets")
-if os.path.exists("dist/audio-processors"):
+if SERVE_STATIC and os.path.exists("dist/audio-processors"):
     app.mount("/audio-processors", StaticFiles(directory="dist/audio-processors"), name="audio-processors")
-# In-memory storage for valid session tokens (Token -> Timestamp)
-valid_tokens: Dict[str, float] = {}
+
+# Files shipped in dist, collected once so the SPA catch-all needs no stat() calls
+DIST_FILES = frozenset(
+    path.relative_to("dist").as_posix() for path in Path("dist").rglob("*") if path.is_file()
+) if SERVE_STATIC else frozenset()
+
+# Session tokens are stateless: "<timestamp>.<nonce>.<hmac-sha256>", signed with
+# WS_TOKEN_SECRET so any worker sharing the secret can validate them.
 TOKEN_EXPIRY_SECONDS = 30
+TOKEN_SECRET = os.getenv("WS_TOKEN_SECRET", "").encode()
+if not TOKEN_SECRET or TOKEN_SECRET == b"change-me":
+    logger.warning("WS_TOKEN_SECRET not set; using a random per-process secret")
+    TOKEN_SECRET = secrets.token_bytes(32)
+
+# Nonces of already-used tokens (Nonce -> Time used), kept for one-time use,
+# split into shards keyed by nonce hash so cleanup only scans one shard.
+# Nonces are inserted in time order, so the oldest is always first. No locks:
+# checking and recording a nonce never awaits, so it is atomic on the event loop.
+# The map is per process: with several workers a token can be used once per
+# worker until it expires.
+_SHARDS = 16
+used_nonce_shards: "List[OrderedDict[str, float]]" = [OrderedDict() for _ in range(_SHARDS)]
 
-def cleanup_tokens():
-    """Remove expired tokens."""
+def _shard_index(nonce: str) -> int:
+    return hash(nonce) & (_SHARDS - 1)
+
+def _sign(payload: str) -> str:
+    return hmac.new(TOKEN_SECRET, payload.encode(), hashlib.sha256).hexdigest()
+
+def cleanup_tokens(shard: "OrderedDict[str, float]"):
+    """Remove expired nonces from the front of an insertion-ordered shard."""
     current_time = time.time()
-    expired = [token for token, ts in valid_tokens.items() if current_time - ts > TOKEN_EXPIRY_SECONDS]
-    for token in expired:
-        del valid_tokens[token]
+    while shard:
+        _, ts = next(iter(shard.items()))
+        if current_time - ts <= TOKEN_EXPIRY_SECONDS:
+            break
+        shard.popitem(last=False)
+
+def issue_token() -> str:
+    """Create a new signed session token."""
+    payload = f"{int(time.time())}.{secrets.token_urlsafe(16)}"
+    return f"{payload}.{_sign(payload)}"
+
+def consume_token(token: str) -> bool:
+    """Validate a session token's signature and age, and mark it used."""
+    try:
+        ts, nonce, signature = token.split(".")
+        issued_at = int(ts)
+    except ValueError:
+        return False
+
+    if not hmac.compare_digest(signature.encode(), _sign(f"{ts}.{nonce}").encode()):
+        return False
+    if time.time() - issued_at > TOKEN_EXPIRY_SECONDS:
+        return False
+
+    # A nonce only needs to be remembered until its token would have expired
+    # anyway, which is never later than TOKEN_EXPIRY_SECONDS after it is used.
+    shard = used_nonce_shards[_shard_index(nonce)]
+    cleanup_tokens(shard)
+    if nonce in shard:
+        return False
+    shard[nonce] = time.time()
+    return True
+
+# Substring every {"type": "image", ...} frame must contain, checked before parsing
+IMAGE_TYPE_MARKER = '"image"'
+
+async def iter_messages(websocket: WebSocket):
+    """
+    Yield raw text/bytes frames until the client disconnects.
+    Starlette only offers typed iterators (iter_text/iter_bytes), and the
+    endpoint multiplexes both, so stop on the disconnect message instead of
+    letting the next receive() raise.
+    """
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            return
+        yield message
 
-@app.get("/{full_path:path}")
 async def serve_spa(full_path: str):
-    # Serve file from dist if it exists
-    file_path = f"dist/{full_path}"
-    if full_path and os.path.exists(file_path) and os.path.isfile(file_path):
-        return FileResponse(file_path)
+    # Serve file from dist if it was shipped
+    if full_path in DIST_FILES:
+        return FileResponse(f"dist/{full_path}")
     
     # Fallback to index.html for SPA routing
     return FileResponse("dist/index.html")
 
-@app.post("/api/auth")
+# Without static serving, unknown paths fall through to FastAPI's 404
+if SERVE_STATIC:
+    app.get("/{full_path:path}")(serve_spa)
+
+@app.post("/api/auth", response_class=ORJSONResponse)
 async def authenticate(request: Request):
     """
     Issues a temporary session token for WebSocket connection.
     """
     try:
-        session_token = str(uuid.uuid4())
-        cleanup_tokens()
-        valid_tokens[session_token] = time.time()
+        session_token = issue_token()
 
-        return {"session_token": session_token, "session_time_limit": SESSION_TIME_LIMIT}
+        # Returned directly to skip FastAPI's jsonable_encoder pass
+        return ORJSONResponse({"session_token": session_token, "session_time_limit": SESSION_TIME_LIMIT})
 
     except Exception as e:
         logger.error(f"Auth error: {e}")
@@ -93,15 +199,12 @@ async def websocket_endpoint(websocket: WebSocket, token: Optional[str] = None):
     """
     await websocket.accept()
     
-    # Validate Token
-    if not token or token not in valid_tokens:
+    # Validate and remove token (one-time use)
+    if not token or not consume_token(token):
         logger.warning("Invalid or missing session token")
         await websocket.close(code=4003, reason="Unauthorized")
         return
-        
-    # Remove token (one-time use)
-    del valid_tokens[token]
-    
+
     logger.info("WebSocket connection accepted and authenticated")
 
     # Wait for initial setup message
@@ -109,63 +212,72 @@ async def websocket_endpoint(websocket: WebSocket, token: Optional[str] = None):
     try:
         # We expect the first message to be the setup JSON
         message = await websocket.receive_text()
-        initial_data = json.loads(message)
+        initial_data = orjson.loads(message)
         if "setup" in initial_data:
             setup_config = initial_data["setup"]
             logger.info("Received setup configuration from client")
     except Exception as e:
         logger.warning(f"Error receiving setup config: {e}")
 
-    audio_input_queue = asyncio.Queue()
-    video_input_queue = asyncio.Queue()
-    text_input_queue = asyncio.Queue()
+    # Bounded so a stalled Gemini session can't grow memory without limit.
+    # Audio/video drop their oldest chunk when full; text applies backpressure.
+    audio_input_queue = SPSCQueue(maxsize=AUDIO_QUEUE_SIZE)
+    video_input_queue = SPSCQueue(maxsize=VIDEO_QUEUE_SIZE)
+    text_input_queue = asyncio.Queue(maxsize=TEXT_QUEUE_SIZE)
+
+    # Outbound audio is coalesced for AUDIO_FLUSH_INTERVAL so that many small
+    # Gemini chunks go out as a single WebSocket frame
+    audio_output_buffer = bytearray()
+    audio_output_ready = asyncio.Event()
+
+    async def flush_audio():
+        if audio_output_buffer:
+            data = bytes(audio_output_buffer)
+            audio_output_buffer.clear()
+            await websocket.send_bytes(data)
+
+    async def flush_audio_periodically():
+        while True:
+            await audio_output_ready.wait()
+            await asyncio.sleep(AUDIO_FLUSH_INTERVAL)
+            audio_output_ready.clear()
+            await flush_audio()
 
     async def audio_output_callback(data):
-        await websocket.send_bytes(data)
+        audio_output_buffer.extend(data)
+        audio_output_ready.set()
 
     async def audio_interrupt_callback():
-        # The event queue handles the JSON message, but we might want to do something else here
-        pass
+        # Drop buffered audio so the client doesn't play it after the interruption
+        audio_output_buffer.clear()
 
-    gemini_client = GeminiLive(
-        project_id=PROJECT_ID,
-        location=LOCATION,
-        model=MODEL,
-        input_sample_rate=16000
-    )
+    gemini_client: GeminiLive = websocket.app.state.gemini_client
 
     async def receive_from_client():
         try:
-            while True:
-                message = await websocket.receive()
-                
+            async for message in iter_messages(websocket):
                 if "bytes" in message and message["bytes"]:
-                    await audio_input_queue.put(message["bytes"])
+                    audio_input_queue.put_nowait(message["bytes"])
                 elif "text" in message and message["text"]:
                     text = message["text"]
-                    try:
-                        payload = json.loads(text)
-                        if isinstance(payload, dict) and payload.get("type") == "image":
-                            # Handle base64 image
-                            image_data = base64.b64decode(payload["data"])
-                            await video_input_queue.put(image_data)
-                            continue
-                        elif isinstance(payload, dict) and "realtime_input" in payload:
-                             # Forward realtime input (audio/video chunks)
-                             # The SDK JS sends 'realtime_input' for generic media chunks
-                             # For now we handle simpler case or adapt GeminiLive class
-                             pass
-                    except json.JSONDecodeError:
-                        pass
-                    
+                    # Only frames mentioning "image" can be image messages, so
+                    # everything else is forwarded without being parsed
+                    if IMAGE_TYPE_MARKER in text:
+                        try:
+                            payload = orjson.loads(text)
+                            if isinstance(payload, dict) and payload.get("type") == "image":
+                                # Handle base64 image
+                                image_data = pybase64.b64decode(payload["data"], validate=False)
+                                video_input_queue.put_nowait(image_data)
+                                continue
+                        except orjson.JSONDecodeError:
+                            pass
+
                     await text_input_queue.put(text)
-        except WebSocketDisconnect:
             logger.info("WebSocket disconnected")
         except Exception as e:
             logger.error(f"Error receiving from client: {e}")
 
-    receive_task = asyncio.create_task(receive_from_client())
-
     async def run_session():
         async for event in gemini_client.start_session(
             audio_input_queue=audio_input_queue,
@@ -176,31 +288,63 @@ async def websocket_endpoint(websocket: WebSocket, token: Optional[str] = None):
             setup_config=setup_config
         ):
             if event:
-                # Forward events (transcriptions, etc) to client
-                await websocket.send_json(event)
+                # Send pending audio first so events stay ordered with it
+                await flush_audio()
+                # Forward events (transcriptions, etc) to client.
+                # Sent as a text frame: the client treats binary frames as audio.
+                await websocket.send_text(orjson.dumps(event).decode())
+        await flush_audio()
+
+    closed = False
+
+    async def safe_close(code: int = 1000, reason: str = ""):
+        """Close the websocket once; shielded so cancellation can't abort the handshake."""
+        nonlocal closed
+        if closed or websocket.client_state == WebSocketState.DISCONNECTED:
+            return
+        closed = True
+        try:
+            await asyncio.shield(websocket.close(code=code, reason=reason))
+        except RuntimeError as e:
+            # The client can still drop the connection while we are closing
+            logger.info(f"Websocket already closed: {e}")
 
     try:
-        await asyncio.wait_for(run_session(), timeout=SESSION_TIME_LIMIT)
-    except asyncio.TimeoutError:
+        async with asyncio.timeout(SESSION_TIME_LIMIT):
+            async with asyncio.TaskGroup() as tg:
+                session_task = tg.create_task(run_session())
+                receive_task = tg.create_task(receive_from_client())
+                flush_task = tg.create_task(flush_audio_periodically())
+
+                # Whichever side finishes first ends the session: a client
+                # disconnect closes the Gemini connection, and vice versa
+                def stop_session(_):
+                    for task in (session_task, receive_task, flush_task):
+                        task.cancel()
+
+                session_task.add_done_callback(stop_session)
+                receive_task.add_done_callback(stop_session)
+    except TimeoutError:
         logger.info("Session time limit reached")
-        try:
-            await websocket.close(code=1000, reason="Session time limit reached")
-        except RuntimeError:
-            # Websocket might be already closed or in a state where it can't be closed
-            logger.info("Websocket already closed when handling timeout")
-        except Exception as e:
-            logger.warning(f"Error closing websocket after timeout: {e}")
+        await safe_close(reason="Session time limit reached")
     except Exception as e:
-        logger.error(f"Error in Gemini session: {e}")
+        # TaskGroup wraps failures in an ExceptionGroup
+        errors = e.exceptions if isinstance(e, ExceptionGroup) else (e,)
+        for error in errors:
+            logger.error(f"Error in Gemini session: {error}")
     finally:
-        receive_task.cancel()
         # Ensure websocket is closed if not already
-        try:
-            await websocket.close()
-        except:
-            pass
+        await safe_close()
 
 if __name__ == "__main__":
     import uvicorn
+    import sys
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=port,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        ws="websockets",
+    )
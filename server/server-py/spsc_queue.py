@@ -0,0 +1,27 @@
+import asyncio
+from collections import deque
+
+
+class SPSCQueue:
+    """
+    Bounded single-producer/single-consumer queue for asyncio.
+    A ring buffer (deque with maxlen) drops the oldest item when full, and a
+    single Event wakes the consumer, avoiding asyncio.Queue's waiter lists.
+    """
+
+    def __init__(self, maxsize: int):
+        self._items = deque(maxlen=maxsize)
+        self._ready = asyncio.Event()
+
+    def __len__(self):
+        return len(self._items)
+
+    def put_nowait(self, item):
+        self._items.append(item)
+        self._ready.set()
+
+    async def get(self):
+        while not self._items:
+            self._ready.clear()
+            await self._ready.wait()
+        return self._items.popleft()